@@ -6,6 +6,10 @@ class Encoder(abc.ABC):
     def write(self, image):
         pass
 
+    def write_many(self, images):
+        for image in images:
+            self.write(image)
+
     @abc.abstractmethod
     def stop(self):
         pass
@@ -9,13 +9,25 @@ class OpenCVEncoder(Encoder):
     def __init__(self, path, fourcc, fps, w, h):
         cv_fourcc = cv2.VideoWriter_fourcc(*fourcc)
         self.writer = cv2.VideoWriter(path, cv_fourcc, fps, (w, h))
+        # Reusable buffer for converted frames
+        self.bgr_buf = np.empty((h, w, 3), dtype=np.uint8)
 
-    def write(self, image):
-        # Convert PIL -> Numpy array and RGB -> BGR colors
+    def _to_bgr(self, image):
+        # Convert PIL -> Numpy array and RGB -> BGR colors into the preallocated buffer
         # noinspection PyUnresolvedReferences
-        cv_img = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+        return cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR, dst=self.bgr_buf)
+
+    def write(self, image):
         # Write data
-        self.writer.write(cv_img)
+        self.writer.write(self._to_bgr(image))
+
+    def write_many(self, images):
+        # Hoist lookups out of the loop
+        to_bgr = self._to_bgr
+        write = self.writer.write
+
+        for image in images:
+            write(to_bgr(image))
 
     def stop(self):
         self.writer.release()
@@ -1,3 +1,6 @@
+import collections
+import queue
+import threading
 from pathlib import Path
 
 from PIL import Image, ImageDraw, ImageFont
@@ -10,8 +13,13 @@ from .text_painter import TextPainter
 from .webp_encoder import WebPEncoder
 
 WATERMARK = "Generated by vardbg"
+ENCODER_QUEUE_SIZE = 4
+ENCODER_BATCH_SIZE = 8
+FRAME_POOL_SIZE = 4
 SAMPLE_CHARS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~ "
 
+FrameState = collections.namedtuple("FrameState", ("code_lines", "cur_line", "output_lines", "exec_info"))
+
 
 class FrameRenderer:
     RED = 0
@@ -21,6 +29,8 @@ class FrameRenderer:
     def __init__(self, path, config_path, show_profile):
         # Config
         self.cfg = Config(config_path)
+        # Colors indexed by the RED, GREEN, and BLUE constants
+        self._colors = (self.cfg.red, self.cfg.green, self.cfg.blue)
         # Video encoder
         ext = Path(path).suffix.lower()[1:]
         if ext == "mp4":
@@ -31,8 +41,15 @@ class FrameRenderer:
             self.encoder = WebPEncoder(path, self.cfg.fps)
         else:
             raise ValueError(f"Unrecognized file extension '{ext}'")
+        # Encode frames on a background thread so that rendering the next frame isn't blocked by it
+        self._encoder_queue = queue.Queue(maxsize=ENCODER_QUEUE_SIZE)
+        self._encoder_error = None
+        self._encoder_thread = threading.Thread(target=self._encode_loop, daemon=True)
+        self._encoder_thread.start()
         # Drawing context
         self.draw = None
+        # Permanent drawing context used for text measurements, independent of the current frame
+        self._measure_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
         # Fonts
         self.body_font = ImageFont.truetype(*self.cfg.font_body)
         self.body_bold_font = ImageFont.truetype(*self.cfg.font_body_bold)
@@ -40,24 +57,35 @@ class FrameRenderer:
         self.head_font = ImageFont.truetype(*self.cfg.font_heading)
         self.intro_font = ImageFont.truetype(*self.cfg.font_intro)
 
-        # Whether the watermark has been drawn on this frame
-        self._watermark_drawn = False
+        # Pre-rendered watermark mask and its position
+        self._watermark_mask = None
+        self._watermark_pos = None
 
         # Whether to show profiler output
         self.show_body_caption = show_profile
 
         # Sizes and positions to be calculated later
+        # Per-character sizes of the monospaced body fonts
+        self.body_char_sizes = None
         # Code body size
         self.line_height = None
         self.body_cols = None
         self._body_rows = None
         self.body_rows = None
+        # Code body position
+        self.body_x = None
+        self.body_y = None
+        self.body_x_end = None
+        self.body_ctx_lines = None
         # Output body start position
         self.out_x = None
         self.out_y = None
         # Output body size
         self.out_cols = None
         self.out_rows = None
+        # Output text position and line spacing
+        self.out_text_y = None
+        self.out_spacing = None
         # Variable body start positions
         self.vars_x = None
         self.vars_y = None
@@ -68,6 +96,10 @@ class FrameRenderer:
         self.vars_rows = None
         self.ovars_cols = None
         self.ovars_rows = None
+        # Variable reference line bounds
+        self.ref_line_pad = None
+        self.ref_line_max_x = None
+        self.ref_line_h = None
 
         # Per-frame positions
         self.last_var_x = None
@@ -77,14 +109,38 @@ class FrameRenderer:
 
         # Current video frame (image)
         self.frame = None
+        # Contents of the current frame, which are drawn when it's finished
+        self.frame_state = None
+        # Last drawn frame and its contents, kept to write it again if the next frame is identical
+        self.last_frame = None
+        self.last_frame_state = None
+        self.last_var_state = None
+
+        # Pool of reusable frame buffers and their drawing contexts
+        # Buffers are returned to the pool once they have been written and are no longer kept as the last frame
+        self._free_frames = queue.Queue()
+        self._frame_refs = collections.defaultdict(int)
+        self._frame_refs_lock = threading.Lock()
+        for _ in range(FRAME_POOL_SIZE):
+            frame = Image.new("RGB", (self.cfg.w, self.cfg.h), self.cfg.bg)
+            self._free_frames.put((frame, ImageDraw.Draw(frame)))
 
         # Text size cache
         self.text_size_cache = {}
+        # Styled code segment cache, keyed by the identity of the cached file lines
+        self.code_segments_cache = {}
+
+        # Populate sizes and positions
+        self.calc_sizes()
 
         # Prepare base frame
         self.base_frame = None
         self.prepare_base_frame()
 
+        # Prepare watermark (if necessary)
+        if self.cfg.watermark:
+            self.prepare_watermark()
+
         # Write intro (if necessary)
         if self.cfg.intro_text and self.cfg.intro_time:
             self.write_intro()
@@ -96,7 +152,7 @@ class FrameRenderer:
             return self.text_size_cache[cache_key]
         else:
             # Multiply string and divide by the factor to get a more precise width
-            w, h = self.draw.textsize(text * factor, **kwargs)
+            w, h = self._measure_draw.textsize(text * factor, **kwargs)
             w /= factor
 
             # Save to cache and return
@@ -114,12 +170,25 @@ class FrameRenderer:
         else:
             ch = 0
 
+        # Body fonts are monospaced, so the size of any text can be derived from its length
+        self.body_char_sizes = {
+            font: (self.text_size(SAMPLE_CHARS, font=font)[0] / len(SAMPLE_CHARS), self.text_size("A", font=font)[1])
+            for font in (self.body_font, self.body_bold_font)
+        }
+
         # Code body size
         self.line_height = mh * self.cfg.line_height
         self.body_cols = int((self.cfg.var_x - self.cfg.sect_padding * 2) / w)
         self._body_rows = (self.cfg.out_y - self.cfg.sect_padding * 2 - ch) / self.line_height
         self.body_rows = int(self._body_rows)
 
+        # Code body position
+        self.body_x = self.cfg.sect_padding
+        self.body_y = self.cfg.sect_padding + self.line_height
+        self.body_x_end = self.cfg.var_x - self.cfg.sect_padding
+        # Number of context lines to show on each side of the current line
+        self.body_ctx_lines = (self._body_rows - 1) / 2
+
         # Output body start position
         self.out_x = self.cfg.sect_padding
         self.out_y = self.cfg.out_y + self.cfg.head_padding * 2 + hh
@@ -128,6 +197,12 @@ class FrameRenderer:
         self.out_cols = self.body_cols
         self.out_rows = round((self.cfg.h - self.out_y) / self.line_height)
 
+        # Output text position and line spacing, matching the vertical centering done by TextPainter
+        # Pillow spaces lines based on the height of "A", which is also the cached character height
+        _, body_ch = self.body_char_sizes[self.body_font]
+        self.out_text_y = self.out_y - self.line_height + (self.line_height - body_ch) / 2
+        self.out_spacing = self.line_height - body_ch
+
         # Variable body start positions
         # Top-left X and Y for last variable section
         self.vars_x = self.cfg.var_x + self.cfg.sect_padding
@@ -146,21 +221,27 @@ class FrameRenderer:
         ovars_h = self.cfg.h - self.cfg.ovar_y
         self.ovars_rows = int((ovars_h - self.cfg.sect_padding * 2) / self.line_height)
 
+        # Variable reference line bounds
+        # Keep half of the padding to the right so the line doesn't exceed the scene width
+        self.ref_line_pad = self.cfg.sect_padding
+        self.ref_line_max_x = self.cfg.w - self.cfg.sect_padding / 2
+        _, self.ref_line_h = self.body_char_sizes[self.body_font]
+
     def get_color(self, col):
-        if col == self.RED:
-            return self.cfg.red
-        elif col == self.GREEN:
-            return self.cfg.green
-        else:
-            return self.cfg.blue
+        return self._colors[col]
 
     def draw_text_center(self, x, y, text, font, color):
-        w, h = self.text_size(text, font=font)
-        self.draw.text((x - w / 2, y - h / 2), text, font=font, fill=color)
+        # Let Pillow center the text natively if it supports anchors (Pillow 8+)
+        if hasattr(self.draw, "textbbox"):
+            self.draw.text((x, y), text, font=font, fill=color, anchor="mm")
+        else:
+            w, h = self.text_size(text, font=font)
+            self.draw.text((x - w / 2, y - h / 2), text, font=font, fill=color)
 
     def prepare_base_frame(self):
-        # Create new empty frame
-        self.new_frame(from_base=False)
+        # Create new empty frame that is kept separate from the reusable frame buffer
+        self.frame = Image.new("RGB", (self.cfg.w, self.cfg.h), self.cfg.bg)
+        self.draw = ImageDraw.Draw(self.frame)
 
         # Draw output section
         # Horizontal divider at 4/5 height
@@ -188,63 +269,168 @@ class FrameRenderer:
         ovar_label_y = self.cfg.ovar_y + self.cfg.head_padding
         self.draw_text_center(var_center_x, ovar_label_y, "Other Variables", self.head_font, self.cfg.fg_heading)
 
-        # Populate sizes and positions
-        self.calc_sizes()
-
         # Save frame as base and reset current frame
         self.base_frame = self.frame
         self.frame = None
 
     def new_frame(self, from_base=True):
-        # Create image
+        # Take a free buffer from the pool, waiting for the encoder to release one if necessary
+        self.frame, self.draw = self._free_frames.get()
+
+        # Reset contents in-place
         if from_base:
-            self.frame = self.base_frame.copy()
+            self.frame.paste(self.base_frame)
         else:
-            self.frame = Image.new("RGB", (self.cfg.w, self.cfg.h), self.cfg.bg)
+            self.frame.paste(self.cfg.bg, (0, 0, self.cfg.w, self.cfg.h))
 
-        # Create drawing context
-        self.draw = ImageDraw.Draw(self.frame)
-        # Reset watermark drawn flag
-        self._watermark_drawn = False
+    def retain_frame(self, pool_frame):
+        with self._frame_refs_lock:
+            self._frame_refs[id(pool_frame[0])] += 1
 
-    def start_frame(self):
-        self.new_frame()
+    def release_frame(self, pool_frame):
+        with self._frame_refs_lock:
+            key = id(pool_frame[0])
+            self._frame_refs[key] -= 1
+
+            # Return buffer to the pool once nothing refers to it anymore
+            if self._frame_refs[key] == 0:
+                self._free_frames.put(pool_frame)
+
+    def start_frame(self, code_lines, cur_line, output_lines):
+        self.frame_state = FrameState(code_lines, cur_line, output_lines, None)
+
+    def set_exec_info(self, nr_times, cur, avg, total):
+        self.frame_state = self.frame_state._replace(exec_info=(nr_times, cur, avg, total))
 
     def finish_frame(self, var_state):
         # Bail out if there's no frame to finish
-        if self.frame is None:
+        if self.frame_state is None:
             return
 
+        state = self.frame_state
+        self.frame_state = None
+
+        # Write the last frame again if nothing has changed
+        # Variable states are compared by identity because their values can be arbitrary objects
+        if self.last_frame is not None and var_state is self.last_var_state and state == self.last_frame_state:
+            self.write_frame(self.last_frame[0], pool_frame=self.last_frame)
+            return
+
+        # Draw frame
+        self.new_frame()
+        self.draw_code(state.code_lines, state.cur_line)
+        self.draw_output(state.output_lines)
+        if state.exec_info is not None:
+            self.draw_exec(*state.exec_info)
+
         # Draw variable state (if available)
         if var_state is not None:
             self.draw_variables(var_state)
 
-        if self.cfg.watermark and not self._watermark_drawn:
+        if self.cfg.watermark:
             self.draw_watermark()
-            self._watermark_drawn = True
 
-        self.encoder.write(self.frame)
+        # Keep the buffer as the last frame and hand it over to the encoder
+        # It must be retained before it's queued, otherwise the encoder could release it back to the pool first
+        pool_frame = (self.frame, self.draw)
+        self.retain_frame(pool_frame)
+        self.write_frame(self.frame, pool_frame=pool_frame)
+        if self.last_frame is not None:
+            self.release_frame(self.last_frame)
+
+        self.last_frame = pool_frame
+        self.last_frame_state = state
+        self.last_var_state = var_state
+        self.frame = None
+
+    def _encode_loop(self):
+        running = True
+        while running:
+            # Wait for a frame, then take any others that are already queued to write them together
+            batch = [self._encoder_queue.get()]
+            while len(batch) < ENCODER_BATCH_SIZE:
+                try:
+                    batch.append(self._encoder_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None signals that no more frames will be written
+            if None in batch:
+                batch = batch[: batch.index(None)]
+                running = False
+
+            # Keep consuming frames after a failure so the renderer never blocks on a full queue or empty pool
+            try:
+                if batch and self._encoder_error is None:
+                    self.encoder.write_many([frame for frame, _ in batch])
+            except Exception as e:
+                self._encoder_error = e
+            finally:
+                for _, pool_frame in batch:
+                    if pool_frame is not None:
+                        self.release_frame(pool_frame)
+
+    def check_encoder(self):
+        # Propagate errors from the encoder thread
+        if self._encoder_error is not None:
+            raise self._encoder_error
+
+    def write_frame(self, frame, pool_frame=None):
+        # Pooled frames are released after being written, other frames must not be modified afterwards
+        self.check_encoder()
+        if pool_frame is not None:
+            self.retain_frame(pool_frame)
+
+        self._encoder_queue.put((frame, pool_frame))
 
     def write_intro(self):
-        # Render frame
-        self.new_frame(from_base=False)
+        # Render a single frame outside of the pool since it's written repeatedly
+        self.frame = Image.new("RGB", (self.cfg.w, self.cfg.h), self.cfg.bg)
+        self.draw = ImageDraw.Draw(self.frame)
         x = self.cfg.w / 2
         y = self.cfg.h / 2
         self.draw_text_center(x, y, self.cfg.intro_text, self.intro_font, self.cfg.fg_heading)
 
-        # Repeatedly write frame
-        frames = round(self.cfg.intro_time * self.cfg.fps)
+        if self.cfg.watermark:
+            self.draw_watermark()
+
+        # Repeatedly write frame for at least one frame
+        frames = max(1, round(self.cfg.intro_time * self.cfg.fps))
         for _ in range(frames):
-            self.finish_frame(None)
+            self.write_frame(self.frame)
+
+        self.frame = None
+
+    def get_code_segments(self, lines):
+        cache_key = id(lines)
+
+        if cache_key in self.code_segments_cache:
+            return self.code_segments_cache[cache_key]
+        else:
+            seg_lines = []
+
+            for line in lines:
+                # Merge adjacent tokens with the same style to draw them in a single call
+                segments = []
+                for token, text in line:
+                    style = self.cfg.styles[token]
+                    if segments and segments[-1][0] == style:
+                        segments[-1][1] += text
+                    else:
+                        segments.append([style, text])
+
+                seg_lines.append(segments)
+
+            # Save to cache and return
+            self.code_segments_cache[cache_key] = seg_lines
+            return seg_lines
 
     def draw_code(self, lines, cur_line):
         cur_idx = cur_line - 1
-
-        # Construct list of (line, highlighted) tuples
-        hlines = [(line, i == cur_idx) for i, line in enumerate(lines)]
+        seg_lines = self.get_code_segments(lines)
 
         # Calculate start and end display indexes with an equivalent number of lines on both sides for context
-        ctx_side_lines = (self._body_rows - 1) / 2
+        ctx_side_lines = self.body_ctx_lines
         start_idx = round(cur_idx - ctx_side_lines)
         end_idx = round(cur_idx + ctx_side_lines)
         # Accommodate for situations where not enough lines are available at the beginning
@@ -253,25 +439,33 @@ class FrameRenderer:
             end_idx += start_extra
             start_idx = 0
         # Slice selected section
-        display_lines = hlines[start_idx:end_idx]
+        display_lines = seg_lines[start_idx:end_idx]
 
         # Construct painter
-        x_start = self.cfg.sect_padding
-        y_start = self.cfg.sect_padding + self.line_height
-        x_end = self.cfg.var_x - self.cfg.sect_padding
-        painter = TextPainter(self, x_start, y_start, self.body_cols, self.body_rows, x_end=x_end, show_truncate=False)
+        painter = TextPainter(
+            self, self.body_x, self.body_y, self.body_cols, self.body_rows, x_end=self.body_x_end, show_truncate=False
+        )
 
         # Render processed lines
-        for i, (line, highlighted) in enumerate(display_lines):
-            bg_color = self.cfg.highlight if highlighted else None
+        write = painter.write
+        highlight = self.cfg.highlight
+        for i, segments in enumerate(display_lines, start_idx):
+            bg_color = highlight if i == cur_idx else None
 
-            for token, text in line:
-                painter.write(text, bg_color=bg_color, **self.cfg.styles[token])
+            for style, text in segments:
+                write(text, bg_color=bg_color, **style)
 
     def draw_output(self, lines):
         lines = lines[-self.out_rows :]
-        painter = TextPainter(self, self.out_x, self.out_y, self.out_cols, self.out_rows)
-        painter.write("\n".join(lines))
+
+        # Lines are already wrapped and use a single style, so draw all of them at once
+        self.draw.multiline_text(
+            (self.out_x, self.out_text_y),
+            "\n".join(lines),
+            fill=self.cfg.fg_body,
+            font=self.body_font,
+            spacing=self.out_spacing,
+        )
 
     def draw_exec(self, nr_times, cur, avg, total):
         plural = "" if nr_times == 1 else "s"
@@ -307,11 +501,13 @@ class FrameRenderer:
 
             painter.write(var.name + ":")
 
+            # Reference highlighting for latest value and matching variables only
+            ref_idx = len(values) - 1 if var.name == state.ref else None
+
             for v_idx, value in enumerate(values):  # sourcery off
                 painter.write("\n    \u2022 ")
 
-                # Reference highlighting for latest value and matching variables only
-                if var.name == state.ref and v_idx == len(values) - 1:
+                if v_idx == ref_idx:
                     v_pos = irepr(painter, value.value, state.value, bold=True, color=state.color, return_pos="H")
                     self.ref_var_x, self.ref_var_y = v_pos
                 else:
@@ -320,11 +516,8 @@ class FrameRenderer:
     def draw_var_ref(self, state):
         # Calculate X position to route the line on
         # It should be as short as possible while not obscuring any variables or exceeding the scene width
-        right_line_x = min(
-            max(self.last_var_x, self.ref_var_x) + self.cfg.sect_padding, self.cfg.w - self.cfg.sect_padding / 2
-        )
-
-        sw, sh = self.text_size(" ", font=self.body_font)
+        right_line_x = min(max(self.last_var_x, self.ref_var_x) + self.ref_line_pad, self.ref_line_max_x)
+        sh = self.ref_line_h
 
         # Draw the polyline
         self.draw.line(
@@ -346,7 +539,7 @@ class FrameRenderer:
         if state.ref is not None:
             self.draw_var_ref(state)
 
-    def draw_watermark(self):
+    def prepare_watermark(self):
         # Get target bottom-right position
         x = self.cfg.w - self.cfg.sect_padding
         y = self.cfg.h - self.cfg.sect_padding
@@ -356,11 +549,32 @@ class FrameRenderer:
         x -= w
         y -= h
 
-        # Draw text
-        self.draw.text((x, y), WATERMARK, fill=self.cfg.fg_watermark, font=self.caption_font)
+        # Render text into a mask covering the remaining area, keeping the fractional part of the position
+        mask_x = int(x)
+        mask_y = int(y)
+        mask = Image.new("L", (self.cfg.w - mask_x, self.cfg.h - mask_y), 0)
+        ImageDraw.Draw(mask).text((x - mask_x, y - mask_y), WATERMARK, fill=255, font=self.caption_font)
+
+        # Crop mask to the drawn glyphs to minimize the area blitted onto each frame
+        bbox = mask.getbbox()
+        if bbox is not None:
+            mask = mask.crop(bbox)
+            mask_x += bbox[0]
+            mask_y += bbox[1]
+
+        self._watermark_mask = mask
+        self._watermark_pos = (mask_x, mask_y)
+
+    def draw_watermark(self):
+        # Blit pre-rendered text
+        self.frame.paste(self.cfg.fg_watermark, self._watermark_pos, self._watermark_mask)
 
     def close(self, var_state):
         # Finish final frame
         self.finish_frame(var_state)
+        # Wait for all pending frames to be encoded
+        self._encoder_queue.put(None)
+        self._encoder_thread.join()
+        self.check_encoder()
         # Close encoder
         self.encoder.stop()
@@ -7,6 +7,7 @@ class TextPainter:
         self.draw = renderer.draw
         self.font = renderer.body_font
         self.bold_font = renderer.body_bold_font
+        self.char_sizes = renderer.body_char_sizes
         self.line_height = renderer.line_height
         self.color = color or renderer.cfg.fg_body
 
@@ -41,6 +42,7 @@ class TextPainter:
     def write(self, text, bold=False, color=None, bg_color=None, return_pos="V"):
         font = self.bold_font if bold else self.font
         color = color or self.color
+        char_w, th = self.char_sizes[font]
         last_draw_x = self.cur_x
         last_draw_y = self.cur_y
         tw = 0
@@ -58,8 +60,8 @@ class TextPainter:
                     self.draw.rectangle(((self.cur_x, self.cur_y), (self.x_end, y_bottom)), fill=bg_color)
 
                 draw_seg = line[:cols_remaining]
-                # Get text size and center it vertically
-                tw, th = self.render.text_size(draw_seg, font=font)
+                # Get text width and center it vertically
+                tw = char_w * len(draw_seg)
                 if is_continuation:
                     center_y = self.last_line_y
                 else:
@@ -8,7 +8,11 @@ class WebPEncoder(Encoder):
         self.fps = fps
 
     def write(self, image):
-        self.frames.append(image)
+        # The renderer reuses its frame buffer, so a copy must be kept
+        self.frames.append(image.copy())
+
+    def write_many(self, images):
+        self.frames.extend(image.copy() for image in images)
 
     def stop(self):
         # WebP requires an integer duration
@@ -1,7 +1,6 @@
 import collections
 import re
 import statistics
-import textwrap
 from pathlib import Path
 
 import pygments
@@ -18,14 +17,11 @@ VarState = collections.namedtuple("VarState", ("name", "color", "action", "value
 def wrap_text(text, cols, rows=None):
     lines = text.replace("\r", "").split("\n")
 
-    # Wrap text
+    # Hard-wrap text at the given column like a terminal would
     wrapped_lines = []
     for line in lines:
-        line_wrapped = textwrap.wrap(line, width=cols)
-        if len(line_wrapped) == 0:
-            wrapped_lines.append("")
-        else:
-            wrapped_lines += line_wrapped
+        line = line.expandtabs()
+        wrapped_lines += [line[i : i + cols] for i in range(0, len(line), cols)] or [""]
 
     # Truncate rows and add indicator if necessary
     if rows is not None and len(wrapped_lines) > rows:
@@ -58,6 +54,9 @@ class VideoWriter(Writer):
     def __init__(self, path, config_path, show_profile):
         # File contents
         self.file_cache = {}
+        # Last program output and its wrapped lines
+        self.last_output = None
+        self.last_output_lines = None
         # Current stack frame snapshot (info)
         self.frame_info = None
         # Last variable state
@@ -74,12 +73,18 @@ class VideoWriter(Writer):
         self.file_cache[path] = lines
         return lines
 
+    def get_output_lines(self, output):
+        # Output often stays the same across several frames, so only wrap it again when it changes
+        if output != self.last_output:
+            self.last_output = output
+            self.last_output_lines = wrap_text(output, self.render.out_cols)
+
+        return self.last_output_lines
+
     def write_cur_frame(self, frame_info, output):
         self.frame_info = frame_info
         self.render.finish_frame(self.last_var)
-        self.render.start_frame()
-        self.render.draw_code(self.get_file_lines(frame_info.file), frame_info.line)
-        self.render.draw_output(wrap_text(output, self.render.out_cols))
+        self.render.start_frame(self.get_file_lines(frame_info.file), frame_info.line, self.get_output_lines(output))
 
     def write_frame_exec(self, frame_info, exec_time, exec_times):
         nr_times = len(exec_times)
@@ -87,7 +92,7 @@ class VideoWriter(Writer):
         total_time = render.duration_ns(sum(exec_times))
         this_time = render.duration_ns(exec_time)
 
-        self.render.draw_exec(nr_times, this_time, avg_time, total_time)
+        self.render.set_exec_info(nr_times, this_time, avg_time, total_time)
 
     def _write_action(self, name, val, color, action, fields, history):
         # Render fields